@@ -1,7 +1,174 @@
+import asyncio
+import functools
+import hashlib
+import io
 import os
-import docx
+import re
+import subprocess
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from xml.sax.saxutils import escape
+import httpx
+import lxml.etree as ET
+import tenacity
 from tqdm import tqdm
-from langchain.llms import Ollama
+from tqdm.asyncio import tqdm_asyncio
+import ollama
+
+def _log_retry(retry_state):
+    # tqdm.write keeps retry noise from clobbering the progress bar.
+    tqdm.write(
+        f"Ollama call failed (attempt {retry_state.attempt_number}), "
+        f"retrying: {retry_state.outcome.exception()}"
+    )
+
+_DOCX_NS = {'w': 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'}
+
+# Constant parts of the minimal OOXML package written for each output file;
+# only word/document.xml varies per response.
+_DOCX_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/word/document.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    '</Types>'
+)
+_DOCX_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="word/document.xml"/>'
+    '</Relationships>'
+)
+
+def _render_document_xml(paragraphs) -> str:
+    body = ''.join(
+        f'<w:p><w:r><w:t xml:space="preserve">{escape(line)}</w:t></w:r></w:p>'
+        for para in paragraphs for line in para.split('\n')
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        f'<w:document xmlns:w="{_DOCX_NS["w"]}"><w:body>{body}</w:body></w:document>'
+    )
+
+def _save_docx(path: str, paragraphs):
+    # Writing the three-part package directly skips python-docx's full
+    # Document object model and template re-serialization on every save.
+    # Write to a .partial file and rename into place so a crash mid-write
+    # can't leave a truncated output that a resume run would trust.
+    partial_path = f'{path}.partial'
+    with zipfile.ZipFile(partial_path, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('[Content_Types].xml', _DOCX_CONTENT_TYPES)
+        z.writestr('_rels/.rels', _DOCX_RELS)
+        z.writestr('word/document.xml', _render_document_xml(paragraphs))
+    os.replace(partial_path, path)
+
+# Matches the "[i]" markers the model is instructed to prefix each answer with.
+_ANSWER_SPLIT = re.compile(r'\n\[(\d+)\]\s*')
+
+# Terms scrubbed from extracted text before it reaches the model.
+_SCRUB = re.compile(r'(?i)gpt|openai|chatgpt')
+
+_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ai_grader')
+
+@functools.lru_cache(maxsize=4096)
+def _extract_text_from_docx(file_path: str, mtime_ns: int) -> str:
+    # Cleaned text is cached in-process (per-path+mtime) and on disk, so the
+    # same report and prompt files aren't re-parsed for every model pass.
+    cache_key = hashlib.sha1(f'{file_path}:{mtime_ns}'.encode()).hexdigest()
+    cache_path = os.path.join(_CACHE_DIR, f'{cache_key}.txt')
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            return f.read()
+    except OSError:
+        pass
+
+    # Go straight at word/document.xml with lxml instead of building
+    # python-docx's per-paragraph object model; we only need the text nodes.
+    # Slurp the file in one read first — the zip central-directory seeks then
+    # hit memory instead of issuing small reads (slow on network mounts).
+    with open(file_path, 'rb') as f:
+        buf = io.BytesIO(f.read())
+    with zipfile.ZipFile(buf) as z, z.open('word/document.xml') as f:
+        tree = ET.parse(f)
+    paras = tree.getroot().findall('.//w:p', _DOCX_NS)
+    raw_text = '\n'.join(
+        text for text in (
+            ''.join(t.text or '' for t in p.findall('.//w:t', _DOCX_NS)) for p in paras
+        ) if text
+    )
+
+    # Case-insensitive scrub in one pass, then a single lowercase: two scans
+    # over the text instead of the old lower() plus three replace() passes.
+    processed_text = _SCRUB.sub('', raw_text).lower()
+
+    # Same write-then-rename idiom as _save_docx: concurrent graders extract
+    # the same files under the same (path, mtime) key, and a reader must
+    # never see a half-written cache file — the mtime key would trust the
+    # truncated text forever. The pid suffix keeps workers from clobbering
+    # each other's in-progress writes.
+    os.makedirs(_CACHE_DIR, exist_ok=True)
+    partial_path = f'{cache_path}.{os.getpid()}.partial'
+    with open(partial_path, 'w', encoding='utf-8') as f:
+        f.write(processed_text)
+    os.replace(partial_path, cache_path)
+
+    return processed_text
+
+_tokenizer = None
+
+def _get_tokenizer():
+    # Loaded lazily and once; only used to budget tokens, not to run a model.
+    global _tokenizer
+    if _tokenizer is None:
+        from transformers import AutoTokenizer
+        _tokenizer = AutoTokenizer.from_pretrained('Qwen/Qwen2.5-7B-Instruct')
+    return _tokenizer
+
+class _TokenBudget:
+    # Admission control by estimated input tokens rather than request count:
+    # a plain Semaphore lets one huge report burst past the server's KV-cache
+    # budget while tiny prompts waste whole slots.
+    def __init__(self, budget: int):
+        self.budget = budget
+        self._in_flight = 0
+        self._cond = asyncio.Condition()
+
+    @asynccontextmanager
+    async def reserve(self, est_tokens: int):
+        est_tokens = min(est_tokens, self.budget)
+        async with self._cond:
+            await self._cond.wait_for(lambda: self._in_flight + est_tokens <= self.budget)
+            self._in_flight += est_tokens
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._in_flight -= est_tokens
+                self._cond.notify_all()
+
+def _extract_folder_texts(report_path: str, prompt_paths: dict) -> tuple:
+    # Runs in a worker process so XML parsing doesn't hold the GIL while
+    # inference requests are in flight on the event loop.
+    report_text = _extract_text_from_docx(report_path, os.stat(report_path).st_mtime_ns)
+    prompt_texts = {
+        num: _extract_text_from_docx(path, os.stat(path).st_mtime_ns)
+        for num, path in prompt_paths.items()
+    }
+    return report_text, prompt_texts
+
+def _index_folder(path: str) -> dict:
+    # One scandir pass per folder; the cached DirEntry objects avoid the
+    # extra stat calls that repeated listdir/isfile lookups would make.
+    entries = {}
+    with os.scandir(path) as it:
+        for entry in it:
+            entries[entry.name.lower()] = entry
+    return entries
 
 class ReportGrader:
     def __init__(
@@ -10,121 +177,253 @@ class ReportGrader:
         model: str = 'mistral:7b-instruct',
         num_ctx: int = 2048,
         temperature: float = 0.7,
-        top_p: float = 0.9
+        top_p: float = 0.9,
+        force: bool = False
     ):
         self.base_directory = base_directory
         self.model = model
         self.num_ctx = num_ctx
         self.temperature = temperature
         self.top_p = top_p
+        self.force = force
+
+        # Async client for the Ollama server. Concurrency is bounded by the
+        # server's parallel slots: run `ollama serve` with OLLAMA_NUM_PARALLEL
+        # set to the slot count (and OLLAMA_MAX_LOADED_MODELS if several
+        # models should stay resident at once).
+        self.client = ollama.AsyncClient()
+        parallel = int(os.getenv('OLLAMA_NUM_PARALLEL', '8'))
+        self.token_budget = _TokenBudget(num_ctx * parallel)
+
+    def _extract_text_from_docx(self, file_path: str) -> str:
+        return _extract_text_from_docx(file_path, os.stat(file_path).st_mtime_ns)
+
+    def _build_combined_prompt(self, prompt_texts: dict, report_text: str) -> str:
+        # One numbered super-prompt so the report is tokenized once instead of
+        # once per prompt, and one HTTP round-trip replaces six.
+        numbered = '\n'.join(f"[{n}] {t}" for n, t in sorted(prompt_texts.items()))
+        return (
+            "Answer each of the following prompts about the report below. "
+            "Prefix each answer with its number in square brackets, e.g. [1].\n"
+            f"{numbered}\n\nREPORT:\n{report_text}"
+        )
+
+    def _split_answers(self, response: str) -> dict:
+        # Empty when the model ignored the numbering; the caller saves the
+        # unsplit response once rather than guessing at per-prompt answers.
+        parts = _ANSWER_SPLIT.split('\n' + response)
+        answers = {}
+        for num, answer in zip(parts[1::2], parts[2::2]):
+            answers[int(num)] = answer.strip()
+        return answers
+
+    def _save_response(self, folder_path: str, report_name: str, prompt_num: int,
+                       prompt_text: str, answer: str):
+        # Prepare output filename
+        output_filename = f'{self.model}_{report_name}_Prompt_{prompt_num}.docx'
+        output_path = os.path.join(folder_path, output_filename)
+
+        # Save response to a new Word document, keeping the original prompt
+        # in the output for reference
+        _save_docx(output_path, [
+            f"Original Prompt (Prompt_{prompt_num}):",
+            prompt_text,
+            "\n--- AI Response ---\n",
+            answer
+        ])
 
-        # Initialize the Ollama LLM with specified settings
-        self.llm = Ollama(
+    # Transient failures (connection resets during long prefill, 503s while
+    # the server swaps models in) used to cost the whole folder; retry with
+    # backoff instead. The 2s floor gives a loading model time to settle.
+    @tenacity.retry(
+        wait=tenacity.wait_exponential(multiplier=1, min=2, max=30),
+        stop=tenacity.stop_after_attempt(5),
+        retry=tenacity.retry_if_exception_type((httpx.TimeoutException, ollama.ResponseError)),
+        before_sleep=_log_retry,
+        reraise=True
+    )
+    async def _chat_with_retry(self, prompt: str):
+        return await self.client.chat(
             model=self.model,
-            num_ctx=self.num_ctx,
-            temperature=self.temperature,
-            top_p=self.top_p,
-            # Add other model parameters as needed
+            messages=[{'role': 'user', 'content': prompt}],
+            options={
+                'num_ctx': self.num_ctx,
+                'temperature': self.temperature,
+                'top_p': self.top_p
+            },
+            # Keep the model resident between calls so prompts within a
+            # pass never pay the multi-second weight reload.
+            keep_alive='30m'
         )
 
-    def _extract_text_from_docx(self, file_path: str) -> str:
-        doc = docx.Document(file_path)
-        
-        raw_text = '\n'.join([para.text for para in doc.paragraphs if para.text])
-        
-        processed_text = raw_text.lower()
-        for term in ['gpt', 'openai', 'chatgpt']:
-            processed_text = processed_text.replace(term, '')
-        
-        return processed_text
-
-    def grade_reports(self):
-        for folder_name in tqdm(os.listdir(self.base_directory), desc=f"Processing Folders with {self.model}"):
-            folder_path = os.path.join(self.base_directory, folder_name)
-            
-            if not os.path.isdir(folder_path):
-                continue
-            
+    async def _grade_folder(self, folder_name: str, folder_path: str,
+                            report_name: str, report_text: str, prompt_texts: dict):
+        try:
+            # Fit the report into what's left of the context window after the
+            # prompts and a little headroom for the instructions and answer.
+            # If it doesn't fit, keep the head and tail and drop the middle.
+            tokenizer = _get_tokenizer()
+            prompt_tokens = sum(len(tokenizer.encode(t)) for t in prompt_texts.values())
+            report_ids = tokenizer.encode(report_text)
+            report_tokens = len(report_ids)
+            max_report_tokens = self.num_ctx - prompt_tokens - 1024
+            if 0 < max_report_tokens < report_tokens:
+                head = max_report_tokens // 2
+                report_text = tokenizer.decode(
+                    report_ids[:head] + report_ids[-(max_report_tokens - head):]
+                )
+                report_tokens = max_report_tokens
+
+            complete_prompt = self._build_combined_prompt(prompt_texts, report_text)
+
+            # Generate response from Ollama, reserving this request's share
+            # of the server's token budget rather than a flat slot
+            async with self.token_budget.reserve(prompt_tokens + report_tokens + 64):
+                response = await self._chat_with_retry(complete_prompt)
+            answers = self._split_answers(response['message']['content'])
+
+            # If the model ignored the [i] numbering there is no honest way
+            # to attribute answers to prompts; save the raw response once
+            # under an unambiguous name instead of writing it into every
+            # per-prompt output as if it were that prompt's answer.
+            if not answers:
+                fallback_path = os.path.join(
+                    folder_path, f'{self.model}_{report_name}_UNSPLIT_RESPONSE.docx'
+                )
+                _save_docx(fallback_path, [
+                    "The model did not number its answers; this is the raw "
+                    f"combined response for prompts {sorted(prompt_texts)}.",
+                    "\n--- AI Response ---\n",
+                    response['message']['content'].strip()
+                ])
+                print(f"Unsplit response for {folder_name} with {self.model}; "
+                      f"saved raw output to {os.path.basename(fallback_path)}")
+                return
+
+            for prompt_num, prompt_text in prompt_texts.items():
+                answer = answers.get(prompt_num)
+                if answer is None:
+                    print(f"No answer for {folder_name}/Prompt_{prompt_num} with {self.model}")
+                    continue
+                self._save_response(folder_path, report_name, prompt_num, prompt_text, answer)
+                print(f"Processed {folder_name} - Prompt {prompt_num} with {self.model}")
+
+        except Exception as e:
+            print(f"Error processing {folder_name} with {self.model}: {e}")
+
+    async def _extract_and_grade(self, pool: ProcessPoolExecutor, folder_name: str,
+                                 folder_path: str, report_entry, prompt_paths: dict):
+        loop = asyncio.get_running_loop()
+        report_text, prompt_texts = await loop.run_in_executor(
+            pool, _extract_folder_texts, report_entry.path, prompt_paths
+        )
+        report_name = os.path.splitext(report_entry.name)[0]
+        await self._grade_folder(folder_name, folder_path, report_name, report_text, prompt_texts)
+
+    async def grade_reports(self):
+        with os.scandir(self.base_directory) as it:
+            folders = [e for e in it if e.is_dir()]
+
+        work = []
+        for folder in tqdm(folders, desc=f"Collecting folders for {self.model}"):
+            entries = _index_folder(folder.path)
+
             # Find the report file
-            report_files = [f for f in os.listdir(folder_path) 
-                            if f.lower().startswith('report_') and f.lower().endswith('.docx')]
-            
-            if not report_files:
+            report_entry = next((e for name, e in entries.items()
+                                 if name.startswith('report_') and name.endswith('.docx')), None)
+
+            if report_entry is None:
                 continue
-            
-            # Process the report
-            report_path = os.path.join(folder_path, report_files[0])
-            report_text = self._extract_text_from_docx(report_path)
-            report_name = os.path.splitext(report_files[0])[0]
-            
-            # Process each prompt from 1 to 6
+
+            report_name = os.path.splitext(report_entry.name)[0]
+
+            # Gather every available prompt path from 1 to 6 in one pass,
+            # skipping prompts whose output already exists from a prior run
+            # (the scandir index makes the existence check free).
+            prompt_paths = {}
             for prompt_num in range(1, 7):
-                # More flexible prompt file matching
-                prompt_files = [f for f in os.listdir(folder_path) 
-                                if f.lower() == f'prompt_{prompt_num}.docx']
-                
-                if not prompt_files:
+                prompt_entry = entries.get(f'prompt_{prompt_num}.docx')
+                if prompt_entry is None:
                     continue
-                
-                prompt_path = os.path.join(folder_path, prompt_files[0])
-                prompt_text = self._extract_text_from_docx(prompt_path)
-                
-                try:
-                    # Use the prompt text as-is, combining it with the report content
-                    complete_prompt = f"{prompt_text}\n\n{report_text}"
-
-                    # Generate response from Ollama
-                    response = self.llm(complete_prompt)
-
-                    # Prepare output filename
-                    output_filename = f'{self.model}_{report_name}_Prompt_{prompt_num}.docx'
-                    output_path = os.path.join(folder_path, output_filename)
-                    
-                    # Save response to a new Word document
-                    output_doc = docx.Document()
-                    
-                    # Add the original prompt to the document for reference
-                    output_doc.add_paragraph(f"Original Prompt (Prompt_{prompt_num}):")
-                    output_doc.add_paragraph(prompt_text)
-                    output_doc.add_paragraph("\n--- AI Response ---\n")
-                    
-                    output_doc.add_paragraph(response)
-                    output_doc.save(output_path)
-                    
-                    print(f"Processed {folder_name} - Prompt {prompt_num} with {self.model}")
-                
-                except Exception as e:
-                    print(f"Error processing {folder_name}/Prompt_{prompt_num} with {self.model}: {e}")
+                output_filename = f'{self.model}_{report_name}_Prompt_{prompt_num}.docx'
+                if not self.force and output_filename.lower() in entries:
+                    continue
+                prompt_paths[prompt_num] = prompt_entry.path
+
+            if not prompt_paths:
+                continue
+
+            work.append((report_entry.stat().st_size, folder, report_entry, prompt_paths))
+
+        # Dispatch the biggest reports first (longest-processing-time order)
+        # so a giant report at the lexicographic tail can't stall the whole
+        # gather on its own. DirEntry.stat() is free here — scandir cached it.
+        work.sort(key=lambda w: -w[0])
+
+        # Docx parsing runs in worker processes so it overlaps with the
+        # in-flight Ollama requests instead of serializing ahead of them.
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+            await tqdm_asyncio.gather(*(
+                self._extract_and_grade(pool, folder.name, folder.path, report_entry, prompt_paths)
+                for _, folder, report_entry, prompt_paths in work
+            ), desc=f"Processing Folders with {self.model}")
+
+# Rough VRAM footprint of one loaded q4_0 model in the sweep, in MiB.
+_VRAM_PER_MODEL_MIB = 8192
+
+def _free_vram_mib():
+    try:
+        out = subprocess.run(
+            ['nvidia-smi', '--query-gpu=memory.free', '--format=csv,noheader,nounits'],
+            capture_output=True, text=True, check=True
+        )
+        return sum(int(x) for x in out.stdout.split())
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return None
+
+async def _run_graders(graders):
+    await asyncio.gather(*(grader.grade_reports() for grader in graders))
 
 def main():
     base_directory = '/home/akash/Downloads/grading_documents'
 
-    # Dictionary of models with their specific context lengths
+    # Dictionary of models with their specific context lengths.
+    # To avoid swapping weights between models, serve with
+    # OLLAMA_MAX_LOADED_MODELS=5 so all five can stay loaded.
     models = {
-        'qwen2.5:7b-instruct-q4_0': 32768, 
-        'llama3.1:8b-instruct-q4_0': 131072, 
-        'gemma2:9b-instruct-q4_0': 8192, 
+        'qwen2.5:7b-instruct-q4_0': 32768,
+        'llama3.1:8b-instruct-q4_0': 131072,
+        'gemma2:9b-instruct-q4_0': 8192,
         'internlm2:7b': 32768,
         'mistral-nemo:12b-instruct-2407-q4_0': 1024000
     }
 
-    # Run with each model
-    for model, context_length in models.items():
-        print(f"\nStarting processing with model: {model}")
-        
-        # Create grader with current model and its specific context length
-        grader = ReportGrader(
-            base_directory, 
-            model=model, 
+    # Create a grader per model with its specific context length
+    graders = [
+        ReportGrader(
+            base_directory,
+            model=model,
             num_ctx=context_length,
             temperature=0.5,
             top_p=0.9
         )
-        
-        # Run grading process for this model
-        grader.grade_reports()
-        
-        print(f"Completed processing with model: {model}")
+        for model, context_length in models.items()
+    ]
+
+    # Run all models under one event loop when they fit in VRAM together;
+    # otherwise fall back to one pass per model so Ollama isn't forced to
+    # thrash weights in and out.
+    free_vram = _free_vram_mib()
+    if free_vram is None or free_vram >= _VRAM_PER_MODEL_MIB * len(graders):
+        os.environ.setdefault('OLLAMA_MAX_LOADED_MODELS', str(len(graders)))
+        print(f"\nStarting processing with {len(graders)} models in parallel")
+        asyncio.run(_run_graders(graders))
+    else:
+        print(f"\nFree VRAM {free_vram} MiB too low for a parallel sweep; running models sequentially")
+        for grader in graders:
+            print(f"\nStarting processing with model: {grader.model}")
+            asyncio.run(grader.grade_reports())
+            print(f"Completed processing with model: {grader.model}")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,9 +1,147 @@
+import asyncio
+import functools
+import hashlib
+import io
+import json
 import os
 import re
-import docx
+import urllib.request
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import escape
+import diskcache
+import httpx
+import lxml.etree as ET
+import tenacity
 from tqdm import tqdm
 from langchain_ollama import ChatOllama
-from langchain.schema import HumanMessage
+from langchain.schema import HumanMessage, SystemMessage
+
+_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'grading_crew')
+
+# Bump to invalidate previously cached LLM responses (e.g. prompt format changes).
+_CACHE_VERSION = 2
+
+_ENCODING = None
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    # Keep the head and tail and drop the middle of an over-long report;
+    # prefill cost scales with input length, so tokens past the context
+    # budget are pure waste. The encoder loads lazily, once.
+    global _ENCODING
+    if _ENCODING is None:
+        import tiktoken
+        _ENCODING = tiktoken.get_encoding('cl100k_base')
+    ids = _ENCODING.encode(text)
+    if len(ids) <= max_tokens:
+        return text
+    tqdm.write(f"Report over token budget ({len(ids)} > {max_tokens}); truncating middle")
+    head = max_tokens // 2
+    return _ENCODING.decode(ids[:head] + ids[-(max_tokens - head):])
+
+_DOCX_W_NS = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+
+def _log_retry(retry_state):
+    # tqdm.write keeps retry noise from clobbering the progress bar.
+    tqdm.write(
+        f"LLM call failed (attempt {retry_state.attempt_number}), "
+        f"retrying: {retry_state.outcome.exception()}"
+    )
+
+# Constant parts of the minimal OOXML package written for each output file;
+# only word/document.xml varies per graded result.
+_DOCX_TEMPLATE_PARTS = {
+    '[Content_Types].xml': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/word/document.xml" '
+        'ContentType="application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+        '</Types>'
+    ),
+    '_rels/.rels': (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+        'Target="word/document.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+def _render_document_xml(text: str) -> str:
+    body = ''.join(
+        f'<w:p><w:r><w:t xml:space="preserve">{escape(line)}</w:t></w:r></w:p>'
+        for line in text.split('\n')
+    )
+    return (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        f'<w:document xmlns:w="{_DOCX_W_NS}"><w:body>{body}</w:body></w:document>'
+    )
+
+def _save_docx(path: str, text: str):
+    # A graded output is plain text, so write the minimal OOXML package
+    # directly instead of building a python-docx Document (which drags in
+    # the whole default part tree per save). The .partial + rename keeps
+    # the resume check from trusting a half-written file.
+    partial_path = f'{path}.partial'
+    with zipfile.ZipFile(partial_path, 'w', zipfile.ZIP_DEFLATED) as z:
+        for name, part in _DOCX_TEMPLATE_PARTS.items():
+            z.writestr(name, part)
+        z.writestr('word/document.xml', _render_document_xml(text))
+    os.replace(partial_path, path)
+
+# Rubric-parsing patterns, compiled once at import instead of per parse.
+# The text is split once at section-header boundaries, then each chunk is
+# matched with a simple anchored pattern — one O(N) pass with no overlapping
+# lookaheads, instead of two backtracking-prone DOTALL scans over the whole
+# rubric.
+# The zero-width multiline lookahead splits in front of every header line,
+# including one at the very start of the text (which a \n-anchored split
+# would fold into the preamble).
+_SECTION_SPLIT_RE = re.compile(r'(?m)^(?=[ \t]*\d+\.\s.*?\(\s*\d+\s*%\))')
+_SECTION_HEADER_RE = re.compile(
+    r'^\s*(?P<section_number>\d+)\.\s*(?P<title>.*?\(\s*(?P<weight>\d+)\s*%\))(?P<body>.*)$',
+    flags=re.DOTALL
+)
+_GRADING_CRITERIA_RE = re.compile(r'Grading Criteria.*', flags=re.IGNORECASE | re.DOTALL)
+
+# Invariant prompt text, assembled once instead of re-interpolated inside
+# the per-section / per-folder loops.
+_SECTION_TAIL = (
+    "\n\nEvaluate the student's work on this section's criteria, give a "
+    "numeric or letter grade, and justify it in 1-2 short paragraphs."
+)
+_FINAL_INSTRUCTIONS = """Instructions:
+1. For each section, note the numeric grade you assigned (out of 100) or letter grade.
+2. Convert each section’s grade into a numeric score, multiply by the weight (%).
+3. Sum these weighted scores to get the final overall score.
+4. Provide the final result, along with a rationale referencing how well the work met all criteria."""
+
+# Extracted text shared by file content hash, so the identical prompt_N.docx
+# distributed to every student folder is parsed once, not once per folder.
+_TEXT_BY_CONTENT: dict = {}
+
+@functools.lru_cache(maxsize=512)
+def _extract_text_from_docx(file_path: str, mtime_ns: int) -> str:
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    content_key = hashlib.blake2b(data, digest_size=16).hexdigest()
+    text = _TEXT_BY_CONTENT.get(content_key)
+    if text is None:
+        # We only need concatenated paragraph text, so skip python-docx's
+        # full object model (styles, sections, runs) and read the w:p/w:t
+        # nodes out of word/document.xml directly.
+        with zipfile.ZipFile(io.BytesIO(data)) as z:
+            root = ET.fromstring(z.read('word/document.xml'))
+        paragraphs = (
+            ''.join(t.text or '' for t in p.iter(f'{{{_DOCX_W_NS}}}t'))
+            for p in root.iter(f'{{{_DOCX_W_NS}}}p')
+        )
+        text = "\n".join(p for p in paragraphs if p.strip())
+        _TEXT_BY_CONTENT[content_key] = text
+    return text
 
 class AgenticReportGrader:
     def __init__(self,
@@ -12,54 +150,134 @@ class AgenticReportGrader:
                  num_ctx: int = 2048,
                  temperature: float = 0.7,
                  top_p: float = 0.9,
-                 num_predict: int = 3000):
+                 num_predict_section: int = 400,
+                 num_predict_final: int = 3000,
+                 max_parallel: int = 8,
+                 force: bool = False,
+                 base_url: str = None):
         self.base_directory = base_directory
         self.model = model
         self.model_name = model.replace(':', '_')  # Sanitize model name for filenames
+        self.force = force
+        self.base_url = base_url or os.getenv('OLLAMA_HOST', 'http://localhost:11434')
+        self.num_ctx = num_ctx
+        self.temperature = temperature
+        self.top_p = top_p
+        # Section rationales are short by instruction; only the final
+        # aggregation needs the long decode budget.
+        self.num_predict_section = num_predict_section
+        self.num_predict_final = num_predict_final
         self.llm = ChatOllama(
             model=model,
+            base_url=self.base_url,
             num_ctx=num_ctx,
             temperature=temperature,
             top_p=top_p,
-            num_predict=num_predict
+            num_predict=num_predict_final,
+            # Pin the model for the whole pass; the default keep_alive lets
+            # Ollama unload weights across idle gaps mid-run.
+            keep_alive="1h"
         )
 
-    def llm_call(self, prompt: str) -> str:
-        messages = [HumanMessage(content=prompt)]
-        response = self.llm(messages)
-        return response.content if hasattr(response, "content") else response
+        # Bound how many section evaluations are in flight at once. The
+        # server must be started with matching parallelism, e.g.
+        #   OLLAMA_NUM_PARALLEL=8 ollama serve
+        # (and OLLAMA_MAX_LOADED_MODELS for multi-model sweeps), otherwise
+        # extra requests just queue server-side. The setdefault only reaches
+        # servers spawned from this process, hence the reachability check.
+        os.environ.setdefault('OLLAMA_NUM_PARALLEL', str(max_parallel))
+        self.max_parallel = int(os.environ['OLLAMA_NUM_PARALLEL'])
+        self.semaphore = asyncio.Semaphore(self.max_parallel)
+        self._check_server()
+
+        # Rubric breakdowns keyed by content hash: prompt_N.docx is usually
+        # the same assignment text in every student folder, so parse it once
+        # and persist the result across runs. diskcache handles concurrent
+        # grader instances; a shared JSON file did not (interleaved dumps
+        # corrupted it and each instance dropped the others' entries).
+        self._section_prompt_cache = diskcache.Cache(
+            os.path.join(_CACHE_DIR, 'section_prompts'))
+
+        # LLM responses keyed by (model, prompt) hash, persisted so reruns
+        # after a crash and repeated (report, section) pairs skip the call.
+        self._response_cache = diskcache.Cache(os.path.join(_CACHE_DIR, 'responses'))
+
+    def _check_server(self):
+        host = self.base_url
+        if not host.startswith('http'):
+            host = f'http://{host}'
+        try:
+            with urllib.request.urlopen(f'{host}/api/ps', timeout=2) as resp:
+                json.load(resp)
+        except (OSError, ValueError):
+            print(f"Warning: could not reach Ollama at {host}/api/ps; "
+                  f"make sure the server is up and serving with "
+                  f"OLLAMA_NUM_PARALLEL={self.max_parallel}, or concurrent "
+                  f"section evaluations will serialize.")
+
+    # A transient blip (connection reset, server busy swapping models) used
+    # to print-and-drop a whole prompt's worth of completed section work;
+    # retry with backoff before giving up. Sections that did finish are
+    # already safe in the response disk cache, so a retried run never
+    # re-spends them.
+    @tenacity.retry(
+        wait=tenacity.wait_exponential(multiplier=1, max=30),
+        stop=tenacity.stop_after_attempt(5),
+        retry=tenacity.retry_if_exception_type((httpx.HTTPError, TimeoutError)),
+        before_sleep=_log_retry,
+        reraise=True
+    )
+    async def allm_call(self, prompt: str, llm=None) -> str:
+        llm = llm if llm is not None else self.llm
+        parts = []
+        async with self.semaphore:
+            async for chunk in llm.astream([HumanMessage(content=prompt)]):
+                parts.append(chunk.content)
+        return "".join(parts)
+
+    def _response_key(self, prompt: str) -> str:
+        # The prompt already embeds the section criteria and report text;
+        # the sampling config is hashed alongside it so graders run with a
+        # different temperature/context never collide on the same entry.
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f"{_CACHE_VERSION}||{self.model}||{self.temperature}||"
+                 f"{self.top_p}||{self.num_ctx}||".encode())
+        h.update(prompt.encode())
+        return h.hexdigest()
+
+    async def _cached_llm_call(self, prompt: str, llm=None) -> str:
+        key = self._response_key(prompt)
+        cached = self._response_cache.get(key)
+        if cached is None:
+            cached = await self.allm_call(prompt, llm=llm)
+            self._response_cache.set(key, cached)
+        return cached
 
     def _extract_text_from_docx(self, file_path: str) -> str:
-        doc = docx.Document(file_path)
-        return "\n".join(para.text for para in doc.paragraphs if para.text.strip())
+        return _extract_text_from_docx(file_path, os.stat(file_path).st_mtime_ns)
 
     def _parse_rubric_text(self, text: str):
-        grading_criteria_pattern = re.compile(
-            r'(Grading Criteria.*?)(?=\n\s*\d+\.\s.*?\(\d+%\)|$)',
-            flags=re.IGNORECASE|re.DOTALL
-        )
-        match_gc = grading_criteria_pattern.search(text)
-        grading_criteria_text = match_gc.group(1).strip() if match_gc else ""
+        preamble, *section_chunks = _SECTION_SPLIT_RE.split(text)
 
-        section_pattern = re.compile(
-            r'(?P<header>(?P<section_number>\d+)\.\s*(?P<title>.*?\(\s*(?P<weight>\d+)\s*%\)))(?P<body>.*?)(?=\n\s*\d+\.\s.*?\(\d+%\)|$)',
-            flags=re.DOTALL
-        )
+        match_gc = _GRADING_CRITERIA_RE.search(preamble)
+        grading_criteria_text = match_gc.group(0).strip() if match_gc else ""
 
         sections = []
-        for m in section_pattern.finditer(text):
-            section_num = int(m.group('section_number'))
-            header = m.group('header').strip()
-            title_str = m.group('title').strip()
-            weight_val = float(m.group('weight').strip())
-            body = m.group('body').strip()
+        for chunk in section_chunks:
+            m = _SECTION_HEADER_RE.match(chunk)
+            if m is None:
+                continue
 
+            # The regex only admits digits for section_number/weight and
+            # anchors the heading slice between the number and the closing
+            # paren, so no .strip() is needed on anything but the body.
+            # Weights are integer percentages; float was gratuitous.
             sections.append({
-                "section_number": section_num,
-                "section_heading": header,
-                "title": title_str,
-                "weight": weight_val,
-                "body_text": body
+                "section_number": int(m['section_number']),
+                "section_heading": chunk[m.start('section_number'):m.end('title')],
+                "title": m['title'],
+                "weight": int(m['weight']),
+                "body_text": m['body'].strip()
             })
 
         return {
@@ -67,104 +285,220 @@ class AgenticReportGrader:
             "sections": sections
         }
 
-    def _build_section_prompts(self, parsed_rubric) -> list:
-        prompts = []
-        for section in parsed_rubric["sections"]:
-            section_prompt = f"""
-Section {section['section_number']} – {section['section_heading']}
-
-Full Rubric Subsection Text:
-{section['body_text']}
-
-Instructions:
-1. Evaluate the student's work specifically on this section's criteria.
-2. Provide a numeric or letter grade for this section.
-3. Provide rationale in 1-2 short paragraphs.
-"""
-            prompts.append(section_prompt.strip())
-        return prompts
+    def _rubric_breakdown(self, rubric_text: str):
+        key = hashlib.blake2b(f"{_CACHE_VERSION}||{rubric_text}".encode(), digest_size=16).hexdigest()
+        cached = self._section_prompt_cache.get(key)
+        if cached is None:
+            parsed_rubric = self._parse_rubric_text(rubric_text)
+            cached = {
+                "parsed_rubric": parsed_rubric,
+                "section_prompts": self._build_section_prompts(parsed_rubric)
+            }
+            self._section_prompt_cache.set(key, cached)
+        return cached["parsed_rubric"], cached["section_prompts"]
 
-    def _build_final_prompt(self, parsed_rubric, section_evaluations: list) -> str:
-        sections_summary = []
-        for s, ev in zip(parsed_rubric["sections"], section_evaluations):
-            sections_summary.append(
-                f"Section {s['section_number']} ({s['weight']}%): {s['title']}\n"
-                f"Evaluation Summary:\n{ev}\n"
-            )
-        sections_text = "\n".join(sections_summary)
+    def _build_section_prompts(self, parsed_rubric) -> list:
+        # Keep the boilerplate tight: the criteria text dominates, and the
+        # invariant instruction tail is a module constant rather than being
+        # re-interpolated per section.
+        return [
+            f"Section {s['section_number']} – {s['section_heading']}\n\n{s['body_text']}"
+            + _SECTION_TAIL
+            for s in parsed_rubric["sections"]
+        ]
 
-        final_prompt = f"""
-You have evaluated each section individually. Now combine those results into a final score.
+    def _build_final_prompt_prefix(self, parsed_rubric) -> str:
+        # Everything known before the section evaluations finish. Kept
+        # byte-identical to the head of the real final prompt so a warm-up
+        # call fills the server's prefix KV cache for it.
+        return f"""You have evaluated each section individually. Now combine those results into a final score.
 
 Grading Criteria Reference:
 {parsed_rubric["grading_criteria"]}
 
 Section Evaluations (with assigned weights):
-{sections_text}
-
-Instructions:
-1. For each section, note the numeric grade you assigned (out of 100) or letter grade.
-2. Convert each section’s grade into a numeric score, multiply by the weight (%).
-3. Sum these weighted scores to get the final overall score.
-4. Provide the final result, along with a rationale referencing how well the work met all criteria.
 """
-        return final_prompt.strip()
 
-    def evaluate_section(self, section_prompt: str, report_text: str, section_number: int) -> str:
-        prompt = f"""
-{section_prompt}
+    def _build_final_prompt(self, parsed_rubric, section_evaluations: list) -> str:
+        sections_text = "\n".join(
+            f"Section {s['section_number']} ({s['weight']}%): {s['title']}\n"
+            f"Evaluation Summary:\n{ev}\n"
+            for s, ev in zip(parsed_rubric["sections"], section_evaluations)
+        )
+        return (self._build_final_prompt_prefix(parsed_rubric)
+                + f"{sections_text}\n\n" + _FINAL_INSTRUCTIONS)
 
---- Student Report Below ---
-{report_text}
-"""
-        return self.llm_call(prompt.strip())
+    async def _warm_model(self):
+        # Best-effort 1-token call so the weight load happens up front,
+        # overlapped with docx collection, instead of inside the first
+        # graded request.
+        try:
+            await self.allm_call("hi", llm=self.llm.bind(num_predict=1))
+        except Exception:
+            pass
 
-    def grade_reports(self):
-        for folder_name in tqdm(os.listdir(self.base_directory), desc="Processing"):
-            folder_path = os.path.join(self.base_directory, folder_name)
-            if not os.path.isdir(folder_path):
-                continue
+    async def _warm_final_prefix(self, parsed_rubric):
+        # Best-effort 1-token call that prefills the final prompt's stable
+        # prefix while the section evaluations are still running; the real
+        # final call then only pays prefill for the appended evaluations.
+        try:
+            await self.allm_call(
+                self._build_final_prompt_prefix(parsed_rubric),
+                llm=self.llm.bind(num_predict=1)
+            )
+        except Exception:
+            pass
+
+    @tenacity.retry(
+        wait=tenacity.wait_exponential(multiplier=1, max=30),
+        stop=tenacity.stop_after_attempt(5),
+        retry=tenacity.retry_if_exception_type((httpx.HTTPError, TimeoutError)),
+        before_sleep=_log_retry,
+        reraise=True
+    )
+    async def _abatch(self, llm, messages_list: list) -> list:
+        responses = await llm.abatch(
+            messages_list,
+            config={"max_concurrency": self.max_parallel}
+        )
+        return [r.content if hasattr(r, "content") else r for r in responses]
 
-            report_files = [
-                f for f in os.listdir(folder_path)
-                if f.lower().startswith('report_') and f.endswith('.docx')
+    async def _evaluate_sections(self, section_prompts: list, report_text: str) -> list:
+        # All of a rubric's sections are independent, so the uncached ones
+        # go to the server as one abatch with LangChain's own concurrency
+        # control; results come back in order and are cached individually.
+        #
+        # The report rides in a system message that is byte-identical for
+        # every section of a folder (nothing section-specific in it), so
+        # Ollama's prefix KV cache pays the report's prefill once per folder
+        # while each human message carries only the short varying criteria.
+        system_content = f"--- Student Report ---\n{report_text}"
+        keys = [self._response_key(f"{system_content}\n\n{sp}") for sp in section_prompts]
+        results = [self._response_cache.get(k) for k in keys]
+
+        missing = [i for i, r in enumerate(results) if r is None]
+        if missing:
+            # Sections ask for 1-2 short paragraphs, so they get the small
+            # section decode budget. num_ctx is quantized to two fixed
+            # buckets (4096 or the grader's full window) rather than sized
+            # per batch: Ollama keys the loaded runner on its options, so a
+            # fresh num_ctx per folder would force a model reload between
+            # the section batch and the final call, throwing away both the
+            # keep_alive pinning and the prefix KV cache.
+            longest = len(system_content) + max(len(section_prompts[i]) for i in missing)
+            est_tokens = 2 * longest // 3 + self.num_predict_section
+            llm_section = self.llm.bind(
+                num_predict=self.num_predict_section,
+                num_ctx=min(self.num_ctx, 4096 if est_tokens <= 4096 else self.num_ctx)
+            )
+            messages_list = [
+                [SystemMessage(content=system_content), HumanMessage(content=section_prompts[i])]
+                for i in missing
             ]
-            if not report_files:
-                continue
-            report_path = os.path.join(folder_path, report_files[0])
-            report_text = self._extract_text_from_docx(report_path)
-
-            for prompt_num in range(1, 7):
-                prompt_files = [
-                    f for f in os.listdir(folder_path)
-                    if f.lower() == f'prompt_{prompt_num}.docx'
-                ]
-                if not prompt_files:
+            for i, text in zip(missing, await self._abatch(llm_section, messages_list)):
+                self._response_cache.set(keys[i], text)
+                results[i] = text
+
+        return results
+
+    async def _process_one(self, folder_name: str, folder_path: str, report_file: str,
+                           report_text: str, prompt_num: int, rubric_text: str):
+        try:
+            parsed_rubric, section_prompts = self._rubric_breakdown(rubric_text)
+            warm_task = asyncio.create_task(self._warm_final_prefix(parsed_rubric))
+            section_evaluations = await self._evaluate_sections(section_prompts, report_text)
+            await warm_task
+
+            final_prompt = self._build_final_prompt(parsed_rubric, section_evaluations)
+            final_output = await self._cached_llm_call(final_prompt)
+
+            # Generate unique filename with model name
+            report_base = os.path.splitext(report_file)[0]
+            output_filename = f"GRADED_{report_base}_Prompt_{prompt_num}_{self.model_name}.docx"
+            output_path = os.path.join(folder_path, output_filename)
+            _save_docx(output_path, final_output)
+
+        except Exception as e:
+            print(f"Error processing {folder_name}/Prompt_{prompt_num}: {e}")
+
+    async def agrade_reports(self):
+        # Submit every docx extraction to a thread pool first (zip inflate
+        # and lxml parsing release the GIL), then resolve the futures into
+        # (folder, prompt) work items and keep every folder's prompts in
+        # flight together. The semaphore in allm_call bounds actual request
+        # concurrency.
+        loop = asyncio.get_running_loop()
+        warm_task = asyncio.create_task(self._warm_model())
+        with os.scandir(self.base_directory) as it:
+            folders = [e for e in it if e.is_dir()]
+
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            pending = []
+            for folder in tqdm(folders, desc="Collecting"):
+                # One scandir pass per folder; report, prompt and
+                # already-graded-output lookups are all O(1) against the map.
+                with os.scandir(folder.path) as it:
+                    entries = {e.name.lower(): e for e in it if e.is_file()}
+
+                report_entry = next(
+                    (e for name, e in entries.items()
+                     if name.startswith('report_') and name.endswith('.docx')), None)
+                if report_entry is None:
                     continue
-                prompt_path = os.path.join(folder_path, prompt_files[0])
-                rubric_text = self._extract_text_from_docx(prompt_path)
-
-                try:
-                    parsed_rubric = self._parse_rubric_text(rubric_text)
-                    section_prompts = self._build_section_prompts(parsed_rubric)
-                    section_evaluations = []
-                    for sp, s_info in zip(section_prompts, parsed_rubric["sections"]):
-                        eval_text = self.evaluate_section(sp, report_text, s_info["section_number"])
-                        section_evaluations.append(eval_text)
-
-                    final_prompt = self._build_final_prompt(parsed_rubric, section_evaluations)
-                    final_output = self.llm_call(final_prompt)
-
-                    # Generate unique filename with model name
-                    report_base = os.path.splitext(report_files[0])[0]
+                report_file = report_entry.name
+                report_base = os.path.splitext(report_file)[0]
+
+                rubric_futures = {}
+                for prompt_num in range(1, 7):
+                    # Cheapest check first: a finished output from a prior
+                    # run means no parsing and no LLM calls for this cell.
                     output_filename = f"GRADED_{report_base}_Prompt_{prompt_num}_{self.model_name}.docx"
-                    output_path = os.path.join(folder_path, output_filename)
-                    doc = docx.Document()
-                    doc.add_paragraph(final_output)
-                    doc.save(output_path)
+                    if not self.force and output_filename.lower() in entries:
+                        continue
+
+                    prompt_entry = entries.get(f'prompt_{prompt_num}.docx')
+                    if prompt_entry is None:
+                        continue
+                    rubric_futures[prompt_num] = loop.run_in_executor(
+                        executor, self._extract_text_from_docx, prompt_entry.path)
+
+                if not rubric_futures:
+                    continue
+                report_future = loop.run_in_executor(
+                    executor, self._extract_text_from_docx, report_entry.path)
+
+                pending.append((folder.name, folder.path, report_file,
+                                report_future, rubric_futures))
 
-                except Exception as e:
-                    print(f"Error processing {folder_name}/Prompt_{prompt_num}: {e}")
+            items = []
+            for folder_name, folder_path, report_file, report_future, rubric_futures in pending:
+                # Budget the report once per folder, leaving room for the
+                # rubric criteria, instructions and the answer.
+                report_text = _truncate_to_tokens(await report_future, self.num_ctx - 1500)
+                for prompt_num, rubric_future in rubric_futures.items():
+                    items.append((folder_name, folder_path, report_file,
+                                  report_text, prompt_num, await rubric_future))
+
+        await warm_task
+        await asyncio.gather(*(self._process_one(*item) for item in items))
+
+    def grade_reports(self):
+        asyncio.run(self.agrade_reports())
+
+def _run_one_model(base_directory: str, model: str, ctx: int, base_url: str = None):
+    print(f"\nStarting grading with {model}" + (f" on {base_url}" if base_url else ""))
+    grader = AgenticReportGrader(
+        base_directory=base_directory,
+        model=model,
+        num_ctx=ctx,
+        temperature=0.1,
+        top_p=0.9,
+        num_predict_section=400,
+        num_predict_final=3000,
+        base_url=base_url
+    )
+    grader.grade_reports()
+    print(f"Completed grading with {model}")
 
 def main():
     base_directory = '/home/akash/Downloads/grading_documents'
@@ -174,18 +508,27 @@ def main():
         'deepseek-r1:8b-llama-distill-q4_K_M': 32768
     }
 
-    for model, ctx in models.items():
-        print(f"\nStarting grading with {model}")
-        grader = AgenticReportGrader(
-            base_directory=base_directory,
-            model=model,
-            num_ctx=ctx,
-            temperature=0.1,
-            top_p=0.9,
-            num_predict=3000
-        )
-        grader.grade_reports()
-        print(f"Completed grading with {model}")
+    # The three model passes are independent jobs; run them on threads so
+    # wall time is the max of the three rather than the sum. The server
+    # needs all models co-resident for this to pay off — hence the
+    # OLLAMA_MAX_LOADED_MODELS default (docx parsing still overlaps even
+    # when the GPU can only hold one model).
+    os.environ.setdefault('OLLAMA_MAX_LOADED_MODELS', str(len(models)))
+
+    # With several Ollama servers (multi-GPU box or remote hosts), set
+    # OLLAMA_HOSTS=http://host:11434,http://host:11435,... and the models
+    # are dealt round-robin across them, one resident model per server,
+    # instead of all competing for one endpoint.
+    hosts = [h.strip() for h in os.getenv('OLLAMA_HOSTS', '').split(',') if h.strip()]
+
+    with ThreadPoolExecutor(max_workers=len(models)) as executor:
+        futures = [
+            executor.submit(_run_one_model, base_directory, model, ctx,
+                            hosts[i % len(hosts)] if hosts else None)
+            for i, (model, ctx) in enumerate(models.items())
+        ]
+        for future in futures:
+            future.result()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file